@@ -1,13 +1,33 @@
 import os
-import json
+import base64
+import codecs
 import hashlib
+import functools
 import secrets
+import time
+import queue
+import threading
+from contextlib import closing, contextmanager
 from datetime import datetime
-from flask import Flask, request, render_template, jsonify, send_file, flash, redirect, url_for
-from cryptography.fernet import Fernet
+from flask import Flask, Response, stream_with_context, request, render_template, jsonify, send_file, flash, redirect, url_for
 import sqlite3
-from io import StringIO, BytesIO
+from io import BytesIO
 import csv
+import orjson
+from cryptography.fernet import InvalidToken
+from cryptography.exceptions import InvalidTag
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+
+# Fernet is only used to decrypt responses stored by older versions. The
+# Rust-backed rfernet is an optional, faster drop-in (not in requirements.txt);
+# pyca's implementation accepts the same tokens.
+try:
+    from rfernet import Fernet, DecryptionError as FernetDecryptionError
+except ImportError:
+    from cryptography.fernet import Fernet
+    FernetDecryptionError = InvalidToken
 
 app = Flask(__name__)
 app.secret_key = os.environ.get('SECRET_KEY', secrets.token_hex(32))
@@ -15,48 +35,470 @@ app.secret_key = os.environ.get('SECRET_KEY', secrets.token_hex(32))
 # Database paths
 DB_PATH = 'vcc_survey.db'
 
+# Number of read-only connections kept open for request handlers
+READ_POOL_SIZE = 4
+
+# Largest survey submission body accepted, in bytes
+MAX_SURVEY_PAYLOAD = 8192
+
+# Seconds the admin company listing and token lookups may be served from cache
+COMPANIES_CACHE_TTL = 5
+
 # Encryption key - IN PRODUCTION, store this securely (env var, key management service, etc.)
-ENCRYPTION_KEY = os.environ.get('ENCRYPTION_KEY', Fernet.generate_key())
+ENCRYPTION_KEY = os.environ.get('ENCRYPTION_KEY') or base64.urlsafe_b64encode(os.urandom(32)).decode()
 cipher_suite = Fernet(ENCRYPTION_KEY)
 
-def get_db():
-    """Get database connection"""
-    conn = sqlite3.connect(DB_PATH)
+# Responses are now sealed with AES-256-GCM under a key derived from
+# ENCRYPTION_KEY (rather than reusing the Fernet key for a second cipher).
+# Stored as version | 12-byte nonce | ciphertext+tag; the version byte
+# leaves room to rotate keys or algorithms later.
+AEAD_VERSION = b'\x81'
+_aead = AESGCM(HKDF(algorithm=hashes.SHA256(), length=32, salt=None,
+                    info=b'vcc-survey response encryption').derive(
+                        base64.urlsafe_b64decode(ENCRYPTION_KEY)))
+
+# Key for the audit-trail IP hash; keyed so hashes can't be reversed by
+# hashing every possible address. BLAKE2b accepts at most 64 key bytes.
+IP_HASH_KEY = (os.environ.get('IP_HASH_KEY', '').encode() or os.urandom(32))[:64]
+
+def _configure_connection(conn):
+    """Apply per-connection PRAGMAs (journal_mode=WAL persists in the file, see init_db)"""
+    conn.execute('PRAGMA synchronous=NORMAL')
+    conn.execute('PRAGMA temp_store=MEMORY')
+    conn.execute('PRAGMA mmap_size=268435456')
+    conn.execute('PRAGMA cache_size=-65536')
+    conn.execute('PRAGMA wal_autocheckpoint=1000')
+    # Off by default in SQLite; rejects responses for a company that was
+    # deleted after its token was cached (see company_by_token)
+    conn.execute('PRAGMA foreign_keys=ON')
     conn.row_factory = sqlite3.Row
     return conn
 
+# Long-lived connections shared by request handlers: a single read-write
+# connection (SQLite allows one writer at a time anyway) and a pool of
+# read-only ones. Opened lazily so each gunicorn worker gets its own.
+_pool_lock = threading.Lock()
+_write_lock = threading.Lock()
+_write_conn = None
+_read_pool = None
+# Bumped after every committed write so in-process caches can tell they're stale
+_write_generation = 0
+
+def _open_pooled_connection(read_only=False):
+    """Open a connection for the pool and apply per-connection PRAGMAs"""
+    # Transactions are managed explicitly by get_db(), hence isolation_level=None
+    if read_only:
+        conn = sqlite3.connect(f'file:{DB_PATH}?mode=ro', uri=True, check_same_thread=False,
+                               isolation_level=None)
+    else:
+        conn = sqlite3.connect(DB_PATH, check_same_thread=False, isolation_level=None)
+    return _configure_connection(conn)
+
+def _init_pool():
+    """Open the shared connections on first use"""
+    global _write_conn, _read_pool
+    with _pool_lock:
+        if _read_pool is None:
+            _write_conn = _open_pooled_connection()
+            # LIFO so the most recently used (warmest cache) connection goes out next
+            pool = queue.LifoQueue(maxsize=READ_POOL_SIZE)
+            for _ in range(READ_POOL_SIZE):
+                pool.put(_open_pooled_connection(read_only=True))
+            _read_pool = pool
+
+@contextmanager
+def get_db(write=False):
+    """
+    Get database connection: borrows a pooled connection for the duration
+    of a with-block, and always hands it back, even when the block raises.
+
+    Read scopes get one of the read-only connections. Write scopes get the
+    shared read-write connection inside a transaction that commits on
+    success and rolls back on error. BEGIN IMMEDIATE takes the write lock up
+    front instead of upgrading from a read lock on the first write, which
+    can fail with SQLITE_BUSY when another worker is submitting.
+    """
+    global _write_generation
+    if _read_pool is None:
+        _init_pool()
+
+    if not write:
+        conn = _read_pool.get()
+        try:
+            yield conn
+        finally:
+            _read_pool.put(conn)
+        return
+
+    with _write_lock:
+        _write_conn.execute('BEGIN IMMEDIATE')
+        try:
+            yield _write_conn
+            _write_conn.execute('COMMIT')
+        except Exception:
+            _write_conn.execute('ROLLBACK')
+            raise
+        _write_generation += 1
+
+# Schema changes for databases created from an older schema.sql, applied in
+# order and tracked with PRAGMA user_version. schema.sql always reflects the
+# result of all of them, so a fresh database starts at len(MIGRATIONS).
+MIGRATIONS = [
+    # 1: unique company_id, required by the submit_survey UPSERT
+    '''
+    DROP INDEX IF EXISTS idx_aggregated_company;
+    CREATE UNIQUE INDEX IF NOT EXISTS idx_ar_company ON aggregated_responses(company_id);
+    ''',
+    # 2: is_primarily_diverse computed by SQLite from the counts (see schema.sql)
+    '''
+    ALTER TABLE aggregated_responses DROP COLUMN is_primarily_diverse;
+    ALTER TABLE aggregated_responses ADD COLUMN is_primarily_diverse INTEGER GENERATED ALWAYS AS (
+        CASE
+            WHEN total_founders = 0 OR total_responses * 1.0 / total_founders <= 0.5 THEN NULL
+            WHEN gender_woman + gender_nonbinary + gender_transgender
+                 + race_black + race_asian + race_hispanic + race_native_american + race_pacific_islander
+                 + lgbtq_yes + disability_yes + veteran_yes + veteran_disabled >= total_responses THEN 1
+            ELSE 0
+        END
+    ) VIRTUAL;
+    ''',
+    # 3: year/name index so the export and admin list read rows pre-sorted
+    '''
+    DROP INDEX IF EXISTS idx_company_year;
+    CREATE INDEX IF NOT EXISTS idx_company_year_name ON portfolio_companies(investment_year DESC, company_name);
+    ''',
+]
+
+def _split_statements(script):
+    """Yield the individual statements of an SQL script"""
+    statement = ''
+    for line in script.splitlines(keepends=True):
+        statement += line
+        if sqlite3.complete_statement(statement):
+            yield statement
+            statement = ''
+
+# Oldest SQLite the schema and migrations run on: the generated
+# is_primarily_diverse column needs 3.31, migration 2's DROP COLUMN 3.35
+MIN_SQLITE_VERSION = (3, 35, 0)
+
 def init_db():
-    """Initialize database with schema"""
-    if not os.path.exists(DB_PATH):
-        conn = sqlite3.connect(DB_PATH)
-        with open('schema.sql', 'r') as f:
-            conn.executescript(f.read())
-        conn.commit()
+    """Initialize database with schema, or migrate an existing one"""
+    if sqlite3.sqlite_version_info < MIN_SQLITE_VERSION:
+        raise RuntimeError(
+            f"SQLite {'.'.join(map(str, MIN_SQLITE_VERSION))} or newer is required, "
+            f"but Python's sqlite3 module is linked against {sqlite3.sqlite_version}"
+        )
+    # Every gunicorn worker calls this on import; transactions are managed
+    # explicitly below so the check and the schema change happen under one lock
+    conn = sqlite3.connect(DB_PATH, isolation_level=None)
+    # WAL lets survey submissions commit without blocking admin reads. The
+    # journal mode is stored in the database file (and can't change inside
+    # a transaction), so set it first. SQLite reports the mode it ended up
+    # in; WAL is unavailable on some filesystems (e.g. network mounts).
+    journal_mode = conn.execute('PRAGMA journal_mode=WAL').fetchone()[0]
+    if journal_mode != 'wal':
+        print(f"Warning: could not enable WAL, database is using journal_mode={journal_mode}")
+
+    # Take the write lock before looking at the schema, so concurrent workers
+    # queue up here and only the first one creates or migrates the database.
+    # One transaction for the whole script: a single commit on first boot,
+    # and a failed migration leaves the database untouched.
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        version = conn.execute('PRAGMA user_version').fetchone()[0]
+        has_schema = conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'portfolio_companies'"
+        ).fetchone()
+
+        if not has_schema:
+            with open('schema.sql', 'r') as f:
+                script = f.read()
+            message = "Database initialized successfully"
+        elif version < len(MIGRATIONS):
+            script = ''.join(MIGRATIONS[version:])
+            message = f"Database migrated to version {len(MIGRATIONS)}"
+        else:
+            script = None
+
+        if script is not None:
+            # executescript() would commit first and drop the lock, so run
+            # the statements one by one inside this transaction
+            for statement in _split_statements(script):
+                conn.execute(statement)
+            conn.execute(f'PRAGMA user_version = {len(MIGRATIONS)}')
+        conn.execute('COMMIT')
+    except Exception:
+        conn.execute('ROLLBACK')
+        raise
+    finally:
         conn.close()
-        print("Database initialized successfully")
 
+    if script is not None:
+        print(message)
+
+# Statements shared by several handlers. Reusing the exact same SQL text
+# lets SQLite's per-connection statement cache skip re-parsing.
+SQL_GET_COMPANY_BY_TOKEN = 'SELECT id, company_name FROM portfolio_companies WHERE survey_link_token = ?'
+SQL_INSERT_COMPANY = 'INSERT INTO portfolio_companies (company_name, investment_year, survey_link_token) VALUES (?, ?, ?)'
+SQL_INSERT_AGG = 'INSERT INTO aggregated_responses (company_id, total_founders) VALUES (?, ?)'
+SQL_INSERT_RESPONSE = 'INSERT INTO individual_responses (company_id, response_data_encrypted, ip_hash) VALUES (?, ?, ?)'
+
+# Survey answers -> aggregated_responses counter column, per question
+RESPONSE_COLUMNS = {
+    'gender': {
+        'woman': 'gender_woman',
+        'man': 'gender_man',
+        'nonbinary': 'gender_nonbinary',
+        'transgender': 'gender_transgender',
+        'none': 'gender_other',
+        'decline': 'gender_declined',
+    },
+    'race': {
+        'black': 'race_black',
+        'asian': 'race_asian',
+        'hispanic': 'race_hispanic',
+        'native_american': 'race_native_american',
+        'pacific_islander': 'race_pacific_islander',
+        'white': 'race_white',
+        'none': 'race_other',
+        'decline': 'race_declined',
+    },
+    'lgbtq': {'yes': 'lgbtq_yes', 'no': 'lgbtq_no', 'decline': 'lgbtq_declined'},
+    'disability': {'yes': 'disability_yes', 'no': 'disability_no', 'decline': 'disability_declined'},
+    'veteran': {
+        'veteran': 'veteran_yes',
+        'disabled_veteran': 'veteran_disabled',
+        'no': 'veteran_no',
+        'decline': 'veteran_declined',
+    },
+    'ca_resident': {'yes': 'ca_resident_yes', 'no': 'ca_resident_no', 'decline': 'ca_resident_declined'},
+}
+# Questions where a founder may select several answers; every other
+# question takes exactly one answer, as a string
+MULTI_CHOICE_FIELDS = ('gender', 'race')
+# Fields of a submission that are kept in the encrypted individual response
+SURVEY_FIELDS = ('decline_all', *RESPONSE_COLUMNS)
+
+# Every per-response counter in aggregated_responses
+AGG_COUNT_COLUMNS = ('total_declined_all',) + tuple(
+    column for columns in RESPONSE_COLUMNS.values() for column in columns.values()
+)
+
+# Adds one response to a company's aggregated record, creating it on the
+# first response. Each counter is bound as 0 or 1, so this one statement
+# covers every combination of answers and stays in the statement cache.
+SQL_UPSERT_AGG = (
+    f'INSERT INTO aggregated_responses (company_id, total_responses, {", ".join(AGG_COUNT_COLUMNS)}, updated_at) '
+    f'VALUES (?, 1, {"?, " * len(AGG_COUNT_COLUMNS)}?) '
+    'ON CONFLICT(company_id) DO UPDATE SET total_responses = total_responses + 1, '
+    + ''.join(f'{c} = {c} + excluded.{c}, ' for c in AGG_COUNT_COLUMNS)
+    + 'updated_at = excluded.updated_at'
+)
+
+@functools.lru_cache(maxsize=4096)
+def _company_by_token(token, ttl_bucket):
+    with get_db() as conn:
+        company = conn.execute(SQL_GET_COMPANY_BY_TOKEN, (token,)).fetchone()
+    return (company['id'], company['company_name']) if company else None
+
+def company_by_token(token):
+    """
+    (id, name) of the company a survey token belongs to, or None. Cleared
+    when this process adds, renames or deletes a company; ttl_bucket rolls
+    over every COMPANIES_CACHE_TTL seconds to pick up other workers' changes.
+    """
+    return _company_by_token(token, int(time.monotonic() // COMPANIES_CACHE_TTL))
+
+@functools.lru_cache(maxsize=4096)
 def hash_ip(ip):
-    """Hash IP address for privacy"""
-    return hashlib.sha256(ip.encode()).hexdigest()
+    """Hash IP address for privacy (cached: founders often submit from the same address)"""
+    return hashlib.blake2b(ip.encode('ascii'), digest_size=16, key=IP_HASH_KEY).digest()
 
 def encrypt_response(response_data):
     """Encrypt survey response data"""
-    json_data = json.dumps(response_data)
-    return cipher_suite.encrypt(json_data.encode())
+    json_data = orjson.dumps(response_data, option=orjson.OPT_UTC_Z | orjson.OPT_NAIVE_UTC)
+    nonce = os.urandom(12)
+    return AEAD_VERSION + nonce + _aead.encrypt(nonce, json_data, None)
 
 def decrypt_response(encrypted_data):
     """Decrypt survey response data - USE ONLY FOR COMPLIANCE"""
-    decrypted = cipher_suite.decrypt(encrypted_data)
-    return json.loads(decrypted.decode())
+    if isinstance(encrypted_data, str):
+        encrypted_data = encrypted_data.encode()
+    # Rows written before AES-GCM hold base64 Fernet tokens
+    if encrypted_data[:1] != AEAD_VERSION:
+        return decrypt_response_fernet(encrypted_data)
+    try:
+        plaintext = _aead.decrypt(encrypted_data[1:13], encrypted_data[13:], None)
+    except (InvalidTag, ValueError):
+        # ValueError: too short to hold a 12-byte nonce
+        raise InvalidToken
+    return orjson.loads(plaintext)
+
+def decrypt_response_fernet(encrypted_data):
+    """Decrypt a legacy base64 Fernet token - USE ONLY FOR COMPLIANCE"""
+    try:
+        if isinstance(encrypted_data, bytes):
+            encrypted_data = encrypted_data.decode()
+        plaintext = cipher_suite.decrypt(encrypted_data)
+    except (FernetDecryptionError, InvalidToken, ValueError):
+        # Raise the same error whichever Fernet implementation is installed
+        raise InvalidToken
+    return orjson.loads(plaintext)
+
+# Survey tokens are pre-generated by a background thread so adding
+# companies (especially via bulk upload) just pops one from the queue
+_token_queue = queue.Queue(maxsize=256)
+_token_lock = threading.Lock()
+_token_thread = None
+
+# Random bytes per token (same strength as secrets.token_urlsafe(32))
+TOKEN_BYTES = 32
+
+def _token_batch(n=64):
+    """n survey tokens from a single os.urandom call"""
+    raw = os.urandom(n * TOKEN_BYTES)
+    return [base64.urlsafe_b64encode(raw[i:i + TOKEN_BYTES]).rstrip(b'=').decode()
+            for i in range(0, len(raw), TOKEN_BYTES)]
+
+def _refill_survey_tokens():
+    """Keep the token queue topped up; blocks while it is full"""
+    while True:
+        for token in _token_batch():
+            _token_queue.put(token)
 
 def generate_survey_token():
     """Generate unique survey token for a company"""
-    return secrets.token_urlsafe(32)
+    global _token_thread
+    if _token_thread is None:
+        # Started lazily so each gunicorn worker runs its own refill thread
+        with _token_lock:
+            if _token_thread is None:
+                _token_thread = threading.Thread(target=_refill_survey_tokens, daemon=True)
+                _token_thread.start()
+    return _token_queue.get()
+
+# Survey submissions are committed by a single writer thread. Whatever
+# queues up while one transaction commits goes into the next one, so a
+# burst of submissions shares a handful of commits instead of taking the
+# write lock once each. Submitters still wait for their own commit.
+SUBMIT_BATCH_SIZE = 256
+# Seconds a submitter waits for its commit before giving up
+SUBMIT_TIMEOUT = 30
+_submit_queue = queue.Queue()
+_submit_lock = threading.Lock()
+_submit_thread = None
+# Guards the taken/cancelled hand-off between the writer and a submitter
+# that timed out, so a submission is either written or cancelled, never both
+_claim_lock = threading.Lock()
+
+class _PendingSubmission:
+    """Rows for one survey submission, and the outcome once committed"""
+    __slots__ = ('response', 'counts', 'done', 'error', 'taken', 'cancelled')
+
+    def __init__(self, response, counts):
+        self.response = response  # SQL_INSERT_RESPONSE parameters
+        self.counts = counts  # SQL_UPSERT_AGG parameters
+        self.done = threading.Event()
+        self.error = None
+        self.taken = False  # picked up by the writer
+        self.cancelled = False  # submitter gave up before it was picked up
+
+def _claim(pending):
+    """Mark a queued submission as taken by the writer, unless it was cancelled"""
+    with _claim_lock:
+        if pending.cancelled:
+            return False
+        pending.taken = True
+        return True
+
+def _write_submissions(batch):
+    """Commit a batch of submissions in one transaction"""
+    if not batch:
+        return
+    try:
+        with get_db(write=True) as conn:
+            conn.executemany(SQL_INSERT_RESPONSE, [p.response for p in batch])
+            conn.executemany(SQL_UPSERT_AGG, [p.counts for p in batch])
+    except sqlite3.IntegrityError as e:
+        if len(batch) > 1:
+            # Retry one at a time so a bad submission only fails itself
+            for pending in batch:
+                _write_submissions([pending])
+            return
+        batch[0].error = e
+    except Exception as e:
+        # Not caused by any one submission (e.g. database is locked):
+        # retrying one by one would only repeat the wait per submission
+        for pending in batch:
+            pending.error = e
+    for pending in batch:
+        pending.done.set()
+
+def _take_submissions(first):
+    """first plus whatever else is queued, up to SUBMIT_BATCH_SIZE, minus cancelled ones"""
+    batch = [first] if _claim(first) else []
+    while len(batch) < SUBMIT_BATCH_SIZE:
+        try:
+            pending = _submit_queue.get_nowait()
+        except queue.Empty:
+            break
+        if _claim(pending):
+            batch.append(pending)
+    return batch
+
+def _run_submission_writer():
+    """Commit queued submissions in batches; blocks while the queue is empty"""
+    while True:
+        _write_submissions(_take_submissions(_submit_queue.get()))
+
+def _flush_now():
+    """Commit anything still queued from the calling thread (for tests)"""
+    while True:
+        try:
+            first = _submit_queue.get_nowait()
+        except queue.Empty:
+            return
+        _write_submissions(_take_submissions(first))
+
+def commit_submission(pending):
+    """Queue a submission for the writer thread and wait until it is committed"""
+    global _submit_thread
+    if _submit_thread is None or not _submit_thread.is_alive():
+        # Started lazily so each gunicorn worker runs its own writer thread,
+        # and restarted if it ever died
+        with _submit_lock:
+            if _submit_thread is None or not _submit_thread.is_alive():
+                _submit_thread = threading.Thread(target=_run_submission_writer, daemon=True)
+                _submit_thread.start()
+    _submit_queue.put(pending)
+    if not pending.done.wait(SUBMIT_TIMEOUT):
+        with _claim_lock:
+            if not pending.taken:
+                pending.cancelled = True
+        if pending.cancelled:
+            # The writer will skip it, so the client's retry isn't counted twice
+            raise TimeoutError('Survey submission was not committed in time')
+        # Already in a transaction: its outcome is being decided, so wait for it
+        pending.done.wait()
+    if pending.error is not None:
+        raise pending.error
+
+# Columns counted as diverse identifications: gender (woman, nonbinary,
+# transgender), race (non-white), LGBTQ+, disability and veteran status
+DIVERSE_COLUMNS = (
+    'gender_woman', 'gender_nonbinary', 'gender_transgender',
+    'race_black', 'race_asian', 'race_hispanic', 'race_native_american', 'race_pacific_islander',
+    'lgbtq_yes', 'disability_yes', 'veteran_yes', 'veteran_disabled',
+)
 
 def calculate_diverse_status(aggregated_data):
     """
     Calculate if company is "primarily diverse"
     Requires: >50% response rate AND >=50% of responders identify as diverse
+
+    The database computes the same thing for aggregated_responses.is_primarily_diverse
+    (a generated column, see schema.sql); this Python version is kept for tests.
     """
     total_founders = aggregated_data['total_founders']
     total_responses = aggregated_data['total_responses']
@@ -64,43 +506,13 @@ def calculate_diverse_status(aggregated_data):
     if total_founders == 0 or total_responses / total_founders <= 0.5:
         return None  # Not enough responses
     
-    # Count diverse identifications
-    diverse_count = 0
-    
-    # Gender: woman, nonbinary, transgender
-    if aggregated_data['gender_woman'] > 0:
-        diverse_count += aggregated_data['gender_woman']
-    if aggregated_data['gender_nonbinary'] > 0:
-        diverse_count += aggregated_data['gender_nonbinary']
-    if aggregated_data['gender_transgender'] > 0:
-        diverse_count += aggregated_data['gender_transgender']
-    
-    # Race: non-white
-    race_diverse = (aggregated_data['race_black'] + 
-                   aggregated_data['race_asian'] + 
-                   aggregated_data['race_hispanic'] +
-                   aggregated_data['race_native_american'] + 
-                   aggregated_data['race_pacific_islander'])
-    
-    # LGBTQ+
-    lgbtq_diverse = aggregated_data['lgbtq_yes']
-    
-    # Disability
-    disability_diverse = aggregated_data['disability_yes']
-    
-    # Veteran
-    veteran_diverse = aggregated_data['veteran_yes'] + aggregated_data['veteran_disabled']
-    
     # Note: A founder can be counted in multiple categories
     # The law defines "diverse" as identifying in ANY of these categories
     # So we need to check if at least 50% of responders have at least one diverse identifier
     
     # This is a simplified calculation - in reality, need to track per-response
     # For now, if total diverse identifications >= responses, likely primarily diverse
-    total_diverse_indicators = (
-        diverse_count + race_diverse + lgbtq_diverse +
-        disability_diverse + veteran_diverse
-    )
+    total_diverse_indicators = sum(aggregated_data[c] for c in DIVERSE_COLUMNS)
 
     # Return 1 or 0 for SQLite compatibility (not True/False)
     return 1 if total_diverse_indicators >= total_responses else 0
@@ -110,191 +522,84 @@ def index():
     """Admin dashboard"""
     return render_template('dashboard.html')
 
-@app.route('/admin/recalculate')
-def recalculate_diverse():
-    """Recalculate diverse status for all companies"""
-    conn = get_db()
-    aggregated_rows = conn.execute('SELECT * FROM aggregated_responses').fetchall()
-
-    for row in aggregated_rows:
-        agg_dict = dict(row)
-        diverse_status = calculate_diverse_status(agg_dict)
-        conn.execute(
-            'UPDATE aggregated_responses SET is_primarily_diverse = ? WHERE company_id = ?',
-            (diverse_status, agg_dict['company_id'])
-        )
-
-    conn.commit()
-    conn.close()
-    return redirect(url_for('list_companies'))
-
 @app.route('/survey/<token>')
 def survey_form(token):
     """Display survey form for founders"""
-    conn = get_db()
-    company = conn.execute(
-        'SELECT * FROM portfolio_companies WHERE survey_link_token = ?',
-        (token,)
-    ).fetchone()
-    conn.close()
-    
+    company = company_by_token(token)
     if not company:
         return "Invalid survey link", 404
     
     return render_template('survey.html', 
-                         company_name=company['company_name'],
+                         company_name=company[1],
                          token=token)
 
 @app.route('/api/submit_survey', methods=['POST'])
 def submit_survey():
     """Handle survey submission - implements anonymization at collection"""
+    # Reject oversized bodies before parsing/encrypting them. Count the bytes
+    # actually read: chunked requests carry no Content-Length to check.
+    body = request.stream.read(MAX_SURVEY_PAYLOAD + 1)
+    if len(body) > MAX_SURVEY_PAYLOAD:
+        return jsonify({'error': 'Payload too large'}), 413
+
+    try:
+        data = orjson.loads(body)
+    except orjson.JSONDecodeError:
+        data = None
+    if not isinstance(data, dict):
+        return jsonify({'error': 'Invalid submission'}), 400
+
     try:
-        data = request.json
         token = data.get('token')
-        
-        conn = get_db()
+        # Checked before the cached lookup, which needs a hashable key
+        if not isinstance(token, str):
+            return jsonify({'error': 'Invalid token'}), 400
+        now = datetime.utcnow()
         
         # Get company
-        company = conn.execute(
-            'SELECT * FROM portfolio_companies WHERE survey_link_token = ?',
-            (token,)
-        ).fetchone()
-        
+        company = company_by_token(token)
         if not company:
-            conn.close()
             return jsonify({'error': 'Invalid token'}), 404
         
-        company_id = company['id']
+        company_id = company[0]
         
-        # Extract response data (remove token before storage)
-        response_data = {k: v for k, v in data.items() if k != 'token'}
-        response_data['submitted_at'] = datetime.utcnow().isoformat()
+        # Extract response data (only known survey fields; never the token)
+        response_data = {k: data[k] for k in SURVEY_FIELDS if k in data}
+        response_data['submitted_at'] = now  # orjson encodes it as ISO 8601 UTC
         
-        # TIER 2: Store encrypted individual response (compliance only)
+        # TIER 2: Encrypted individual response (compliance only)
         encrypted_data = encrypt_response(response_data)
         ip_hash = hash_ip(request.remote_addr)
         
-        conn.execute(
-            'INSERT INTO individual_responses (company_id, response_data_encrypted, ip_hash) VALUES (?, ?, ?)',
-            (company_id, encrypted_data, ip_hash)
-        )
-        
-        # TIER 1: Update aggregated counts (operational data)
-        aggregated = conn.execute(
-            'SELECT * FROM aggregated_responses WHERE company_id = ?',
-            (company_id,)
-        ).fetchone()
-        
-        if not aggregated:
-            # Create initial aggregated record
-            conn.execute(
-                'INSERT INTO aggregated_responses (company_id) VALUES (?)',
-                (company_id,)
-            )
-            aggregated = conn.execute(
-                'SELECT * FROM aggregated_responses WHERE company_id = ?',
-                (company_id,)
-            ).fetchone()
-        
-        # Convert to dict for easier manipulation
-        agg_dict = dict(aggregated)
-        
-        # Update counts based on response
-        agg_dict['total_responses'] += 1
-        
-        # Check if declined all
+        # TIER 1: Aggregated counts (operational data)
+        increments = dict.fromkeys(AGG_COUNT_COLUMNS, 0)
         if data.get('decline_all'):
-            agg_dict['total_declined_all'] += 1
+            increments['total_declined_all'] = 1
         else:
-            # Gender (single selection)
-            gender = data.get('gender')
-            if gender == 'woman':
-                agg_dict['gender_woman'] += 1
-            elif gender == 'man':
-                agg_dict['gender_man'] += 1
-            elif gender == 'nonbinary':
-                agg_dict['gender_nonbinary'] += 1
-            elif gender == 'transgender':
-                agg_dict['gender_transgender'] += 1
-            elif gender == 'none':
-                agg_dict['gender_other'] += 1
-            elif gender == 'decline':
-                agg_dict['gender_declined'] += 1
-
-            # Race (single selection)
-            race = data.get('race')
-            if race == 'black':
-                agg_dict['race_black'] += 1
-            elif race == 'asian':
-                agg_dict['race_asian'] += 1
-            elif race == 'hispanic':
-                agg_dict['race_hispanic'] += 1
-            elif race == 'native_american':
-                agg_dict['race_native_american'] += 1
-            elif race == 'pacific_islander':
-                agg_dict['race_pacific_islander'] += 1
-            elif race == 'white':
-                agg_dict['race_white'] += 1
-            elif race == 'none':
-                agg_dict['race_other'] += 1
-            elif race == 'decline':
-                agg_dict['race_declined'] += 1
-            
-            # LGBTQ+
-            lgbtq = data.get('lgbtq')
-            if lgbtq == 'yes':
-                agg_dict['lgbtq_yes'] += 1
-            elif lgbtq == 'no':
-                agg_dict['lgbtq_no'] += 1
-            elif lgbtq == 'decline':
-                agg_dict['lgbtq_declined'] += 1
-            
-            # Disability
-            disability = data.get('disability')
-            if disability == 'yes':
-                agg_dict['disability_yes'] += 1
-            elif disability == 'no':
-                agg_dict['disability_no'] += 1
-            elif disability == 'decline':
-                agg_dict['disability_declined'] += 1
-            
-            # Veteran
-            veteran = data.get('veteran')
-            if veteran == 'veteran':
-                agg_dict['veteran_yes'] += 1
-            elif veteran == 'disabled_veteran':
-                agg_dict['veteran_disabled'] += 1
-            elif veteran == 'no':
-                agg_dict['veteran_no'] += 1
-            elif veteran == 'decline':
-                agg_dict['veteran_declined'] += 1
-            
-            # California residency
-            ca_resident = data.get('ca_resident')
-            if ca_resident == 'yes':
-                agg_dict['ca_resident_yes'] += 1
-            elif ca_resident == 'no':
-                agg_dict['ca_resident_no'] += 1
-            elif ca_resident == 'decline':
-                agg_dict['ca_resident_declined'] += 1
-        
-        # Calculate diverse status
-        agg_dict['is_primarily_diverse'] = calculate_diverse_status(agg_dict)
-        agg_dict['updated_at'] = datetime.utcnow().isoformat()
-        
-        # Update aggregated record
-        update_fields = [f"{k} = ?" for k in agg_dict.keys() if k not in ['id', 'company_id']]
-        update_values = [v for k, v in agg_dict.items() if k not in ['id', 'company_id']]
-        update_values.append(company_id)
-        
-        conn.execute(
-            f'UPDATE aggregated_responses SET {", ".join(update_fields)} WHERE company_id = ?',
-            update_values
-        )
-        
-        conn.commit()
-        conn.close()
-        
+            for field, columns in RESPONSE_COLUMNS.items():
+                # Multi-choice questions may carry a list of answers; a list
+                # sent for a single-choice question is not counted
+                value = data.get(field)
+                if isinstance(value, list) and field in MULTI_CHOICE_FIELDS:
+                    selected = value
+                else:
+                    selected = (value,)
+                for v in selected:
+                    if isinstance(v, str) and v in columns:
+                        increments[columns[v]] = 1
+
+        # Both tiers are written in the same transaction
+        try:
+            commit_submission(_PendingSubmission(
+                (company_id, encrypted_data, ip_hash),
+                (company_id, *increments.values(), now.isoformat())
+            ))
+        except sqlite3.IntegrityError:
+            # The company was deleted (possibly by another worker) since
+            # its token was cached
+            _company_by_token.cache_clear()
+            return jsonify({'error': 'Invalid token'}), 404
+
         return jsonify({'success': True, 'message': 'Thank you for completing the survey'})
         
     except Exception as e:
@@ -304,45 +609,58 @@ def submit_survey():
 @app.route('/admin/companies')
 def list_companies():
     """List all portfolio companies and their response status"""
-    conn = get_db()
-    companies = conn.execute('''
-        SELECT 
-            pc.*,
-            ar.total_founders,
-            ar.total_responses,
-            ar.is_primarily_diverse
-        FROM portfolio_companies pc
-        LEFT JOIN aggregated_responses ar ON pc.id = ar.company_id
-        ORDER BY pc.investment_year DESC, pc.company_name
-    ''').fetchall()
-    conn.close()
-    
-    return render_template('companies.html', companies=companies)
+    return render_template('companies.html', companies=_company_listing())
+
+# (write generation, expiry, rows) for the /admin/companies query
+_companies_cache = (None, 0.0, None)
+
+def _company_listing():
+    """
+    Companies joined with their response status, cached until the next write
+    in this process or COMPANIES_CACHE_TTL seconds (writes made by other
+    gunicorn workers), whichever comes first
+    """
+    global _companies_cache
+    generation, expires_at, companies = _companies_cache
+    if generation == _write_generation and time.monotonic() < expires_at:
+        return companies
+
+    generation = _write_generation
+    with get_db() as conn:
+        companies = conn.execute('''
+            SELECT 
+                pc.*,
+                ar.total_founders,
+                ar.total_responses,
+                ar.is_primarily_diverse
+            FROM portfolio_companies pc
+            LEFT JOIN aggregated_responses ar ON pc.id = ar.company_id
+            ORDER BY pc.investment_year DESC, pc.company_name
+        ''').fetchall()
+    _companies_cache = (generation, time.monotonic() + COMPANIES_CACHE_TTL, companies)
+    return companies
 
 @app.route('/admin/company/<int:company_id>')
 def company_detail(company_id):
     """View aggregated data for a specific company"""
-    conn = get_db()
-    company = conn.execute(
-        'SELECT * FROM portfolio_companies WHERE id = ?',
-        (company_id,)
-    ).fetchone()
-    
-    if not company:
-        conn.close()
-        return "Company not found", 404
-    
-    aggregated = conn.execute(
-        'SELECT * FROM aggregated_responses WHERE company_id = ?',
-        (company_id,)
-    ).fetchone()
-    
-    response_count = conn.execute(
-        'SELECT COUNT(*) as count FROM individual_responses WHERE company_id = ?',
-        (company_id,)
-    ).fetchone()['count']
-    
-    conn.close()
+    with get_db() as conn:
+        company = conn.execute(
+            'SELECT * FROM portfolio_companies WHERE id = ?',
+            (company_id,)
+        ).fetchone()
+        
+        if not company:
+            return "Company not found", 404
+        
+        aggregated = conn.execute(
+            'SELECT * FROM aggregated_responses WHERE company_id = ?',
+            (company_id,)
+        ).fetchone()
+        
+        response_count = conn.execute(
+            'SELECT COUNT(*) as count FROM individual_responses WHERE company_id = ?',
+            (company_id,)
+        ).fetchone()['count']
     
     return render_template('company_detail.html',
                          company=company,
@@ -352,12 +670,11 @@ def company_detail(company_id):
 @app.route('/admin/company/<int:company_id>/delete', methods=['POST'])
 def delete_company(company_id):
     """Delete a company and all its data"""
-    conn = get_db()
-    conn.execute('DELETE FROM individual_responses WHERE company_id = ?', (company_id,))
-    conn.execute('DELETE FROM aggregated_responses WHERE company_id = ?', (company_id,))
-    conn.execute('DELETE FROM portfolio_companies WHERE id = ?', (company_id,))
-    conn.commit()
-    conn.close()
+    with get_db(write=True) as conn:
+        conn.execute('DELETE FROM individual_responses WHERE company_id = ?', (company_id,))
+        conn.execute('DELETE FROM aggregated_responses WHERE company_id = ?', (company_id,))
+        conn.execute('DELETE FROM portfolio_companies WHERE id = ?', (company_id,))
+    _company_by_token.cache_clear()
     flash('Company deleted successfully', 'success')
     return redirect(url_for('list_companies'))
 
@@ -368,29 +685,13 @@ def update_founders(company_id):
     if total_founders < 1:
         total_founders = 1
 
-    conn = get_db()
-    conn.execute(
-        'UPDATE aggregated_responses SET total_founders = ? WHERE company_id = ?',
-        (total_founders, company_id)
-    )
-
-    # Recalculate diverse status
-    aggregated = conn.execute(
-        'SELECT * FROM aggregated_responses WHERE company_id = ?',
-        (company_id,)
-    ).fetchone()
-
-    if aggregated:
-        agg_dict = dict(aggregated)
-        agg_dict['total_founders'] = total_founders
-        diverse_status = calculate_diverse_status(agg_dict)
+    with get_db(write=True) as conn:
+        # is_primarily_diverse is a generated column, so it follows automatically
         conn.execute(
-            'UPDATE aggregated_responses SET is_primarily_diverse = ? WHERE company_id = ?',
-            (diverse_status, company_id)
+            'UPDATE aggregated_responses SET total_founders = ? WHERE company_id = ?',
+            (total_founders, company_id)
         )
 
-    conn.commit()
-    conn.close()
     flash(f'Founder count updated to {total_founders}', 'success')
     return redirect(url_for('company_detail', company_id=company_id))
 
@@ -402,13 +703,12 @@ def update_company_name(company_id):
         flash('Company name cannot be empty', 'error')
         return redirect(url_for('company_detail', company_id=company_id))
 
-    conn = get_db()
-    conn.execute(
-        'UPDATE portfolio_companies SET company_name = ? WHERE id = ?',
-        (company_name, company_id)
-    )
-    conn.commit()
-    conn.close()
+    with get_db(write=True) as conn:
+        conn.execute(
+            'UPDATE portfolio_companies SET company_name = ? WHERE id = ?',
+            (company_name, company_id)
+        )
+    _company_by_token.cache_clear()
     flash(f'Company name updated to "{company_name}"', 'success')
     return redirect(url_for('company_detail', company_id=company_id))
 
@@ -426,21 +726,19 @@ def add_company():
         
         token = generate_survey_token()
         
-        conn = get_db()
-        cursor = conn.execute(
-            'INSERT INTO portfolio_companies (company_name, investment_year, survey_link_token) VALUES (?, ?, ?)',
-            (company_name, int(investment_year), token)
-        )
-        company_id = cursor.lastrowid
-        
-        # Initialize aggregated_responses with total_founders
-        conn.execute(
-            'INSERT INTO aggregated_responses (company_id, total_founders) VALUES (?, ?)',
-            (company_id, total_founders)
-        )
-        
-        conn.commit()
-        conn.close()
+        with get_db(write=True) as conn:
+            cursor = conn.execute(
+                SQL_INSERT_COMPANY,
+                (company_name, int(investment_year), token)
+            )
+            company_id = cursor.lastrowid
+            
+            # Initialize aggregated_responses with total_founders
+            conn.execute(
+                SQL_INSERT_AGG,
+                (company_id, total_founders)
+            )
+        _company_by_token.cache_clear()
         
         flash(f'Company added successfully. Survey link: {request.host_url}survey/{token}', 'success')
         return redirect(url_for('list_companies'))
@@ -465,13 +763,14 @@ def bulk_upload():
             return redirect(url_for('bulk_upload'))
 
         try:
-            # Read CSV content
-            content = file.read().decode('utf-8')
-            reader = csv.DictReader(StringIO(content))
-
-            conn = get_db()
-            created_count = 0
-
+            # Decode the upload as the CSV reader pulls lines from it,
+            # rather than reading and decoding the whole file up front.
+            # (Not TextIOWrapper: Werkzeug spools uploads to a
+            # SpooledTemporaryFile, which lacks readable() before Python 3.11.)
+            reader = csv.DictReader(codecs.iterdecode(file.stream, 'utf-8'))
+
+            companies = []
+            founders = []
             for row in reader:
                 company_name = row.get('company_name', '').strip()
                 investment_year = row.get('investment_year', '').strip()
@@ -481,21 +780,21 @@ def bulk_upload():
                     continue
 
                 token = generate_survey_token()
-
-                cursor = conn.execute(
-                    'INSERT INTO portfolio_companies (company_name, investment_year, survey_link_token) VALUES (?, ?, ?)',
-                    (company_name, int(investment_year), token)
+                companies.append((company_name, int(investment_year), token))
+                founders.append((int(total_founders), token))
+
+            # Parse first, then insert everything in one transaction with two
+            # executemany passes. executemany can't hand back the new ids, so
+            # the second pass looks each company up by its (indexed) token.
+            with get_db(write=True) as conn:
+                conn.executemany(SQL_INSERT_COMPANY, companies)
+                conn.executemany(
+                    'INSERT INTO aggregated_responses (company_id, total_founders) '
+                    'SELECT id, ? FROM portfolio_companies WHERE survey_link_token = ?',
+                    founders
                 )
-                company_id = cursor.lastrowid
-
-                conn.execute(
-                    'INSERT INTO aggregated_responses (company_id, total_founders) VALUES (?, ?)',
-                    (company_id, int(total_founders))
-                )
-                created_count += 1
-
-            conn.commit()
-            conn.close()
+            _company_by_token.cache_clear()
+            created_count = len(companies)
 
             flash(f'Successfully created {created_count} companies', 'success')
             return redirect(url_for('list_companies'))
@@ -517,31 +816,16 @@ def bulk_template():
         download_name='company_upload_template.csv'
     )
 
+class _Echo:
+    """File-like object whose write() hands the line back to csv.writer's caller"""
+    def write(self, value):
+        return value
+
 @app.route('/admin/export_dfpi/<int:year>')
 def export_dfpi_report(year):
     """Export DFPI report for a specific year"""
-    conn = get_db()
-    
-    # Get all companies and their aggregated data for the year
-    companies = conn.execute('''
-        SELECT 
-            pc.company_name,
-            pc.investment_year,
-            ar.*
-        FROM portfolio_companies pc
-        LEFT JOIN aggregated_responses ar ON pc.id = ar.company_id
-        WHERE pc.investment_year = ?
-        ORDER BY pc.company_name
-    ''', (year,)).fetchall()
-    
-    conn.close()
-    
-    # Generate CSV
-    output = StringIO()
-    writer = csv.writer(output)
-    
     # Headers (simplified - adjust based on actual DFPI requirements)
-    writer.writerow([
+    headers = [
         'Company Name',
         'Investment Year',
         'Total Founders',
@@ -562,43 +846,53 @@ def export_dfpi_report(year):
         'Veteran/Disabled Veteran',
         'CA Resident',
         'Primarily Diverse'
-    ])
+    ]
     
-    for company in companies:
-        if company['total_founders']:
-            response_rate = (company['total_responses'] / company['total_founders']) * 100
-        else:
-            response_rate = 0
-        
-        writer.writerow([
-            company['company_name'],
-            company['investment_year'],
-            company['total_founders'] or 0,
-            company['total_responses'] or 0,
-            f"{response_rate:.1f}",
-            company['gender_woman'] or 0,
-            company['gender_man'] or 0,
-            company['gender_nonbinary'] or 0,
-            company['gender_transgender'] or 0,
-            company['race_black'] or 0,
-            company['race_asian'] or 0,
-            company['race_hispanic'] or 0,
-            company['race_native_american'] or 0,
-            company['race_pacific_islander'] or 0,
-            company['race_white'] or 0,
-            company['lgbtq_yes'] or 0,
-            company['disability_yes'] or 0,
-            (company['veteran_yes'] or 0) + (company['veteran_disabled'] or 0),
-            company['ca_resident_yes'] or 0,
-            'Yes' if company['is_primarily_diverse'] else 'No' if company['is_primarily_diverse'] is not None else 'Insufficient Data'
-        ])
+    # Rows come out of SQLite already in CSV column order
+    sql = '''
+        SELECT 
+            pc.company_name,
+            pc.investment_year,
+            COALESCE(ar.total_founders, 0),
+            COALESCE(ar.total_responses, 0),
+            printf('%.1f', CASE WHEN ar.total_founders
+                THEN 100.0 * ar.total_responses / ar.total_founders ELSE 0 END),
+            COALESCE(ar.gender_woman, 0),
+            COALESCE(ar.gender_man, 0),
+            COALESCE(ar.gender_nonbinary, 0),
+            COALESCE(ar.gender_transgender, 0),
+            COALESCE(ar.race_black, 0),
+            COALESCE(ar.race_asian, 0),
+            COALESCE(ar.race_hispanic, 0),
+            COALESCE(ar.race_native_american, 0),
+            COALESCE(ar.race_pacific_islander, 0),
+            COALESCE(ar.race_white, 0),
+            COALESCE(ar.lgbtq_yes, 0),
+            COALESCE(ar.disability_yes, 0),
+            COALESCE(ar.veteran_yes, 0) + COALESCE(ar.veteran_disabled, 0),
+            COALESCE(ar.ca_resident_yes, 0),
+            CASE WHEN ar.is_primarily_diverse IS NULL THEN 'Insufficient Data'
+                 WHEN ar.is_primarily_diverse THEN 'Yes' ELSE 'No' END
+        FROM portfolio_companies pc
+        LEFT JOIN aggregated_responses ar ON pc.id = ar.company_id
+        WHERE pc.investment_year = ?
+        ORDER BY pc.company_name
+    '''
     
-    output.seek(0)
+    def generate():
+        # Stream the CSV a row at a time; the pooled connection is held
+        # until the generator finishes or the client disconnects
+        writer = csv.writer(_Echo())
+        yield writer.writerow(headers)
+        with get_db() as conn, closing(conn.execute(sql, (year,))) as cursor:
+            # Closing the cursor resets the statement, so a download cut
+            # short doesn't leave the pooled connection holding a read snapshot
+            for row in cursor:
+                yield writer.writerow(row)
     
     # Return as downloadable file
-    from flask import Response
     return Response(
-        output.getvalue(),
+        stream_with_context(generate()),
         mimetype='text/csv',
         headers={'Content-Disposition': f'attachment;filename=dfpi_report_{year}.csv'}
     )
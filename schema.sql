@@ -57,8 +57,17 @@ CREATE TABLE aggregated_responses (
     ca_resident_no INTEGER NOT NULL DEFAULT 0,
     ca_resident_declined INTEGER NOT NULL DEFAULT 0,
     
-    -- Calculated flags
-    is_primarily_diverse BOOLEAN,
+    -- Calculated flags (mirrors calculate_diverse_status in app.py):
+    -- NULL below a 50% response rate, else 1 if diverse identifications >= responses
+    is_primarily_diverse INTEGER GENERATED ALWAYS AS (
+        CASE
+            WHEN total_founders = 0 OR total_responses * 1.0 / total_founders <= 0.5 THEN NULL
+            WHEN gender_woman + gender_nonbinary + gender_transgender
+                 + race_black + race_asian + race_hispanic + race_native_american + race_pacific_islander
+                 + lgbtq_yes + disability_yes + veteran_yes + veteran_disabled >= total_responses THEN 1
+            ELSE 0
+        END
+    ) VIRTUAL,
     
     updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
     FOREIGN KEY (company_id) REFERENCES portfolio_companies(id)
@@ -72,7 +81,7 @@ CREATE TABLE individual_responses (
     company_id INTEGER NOT NULL,
     response_data_encrypted BLOB NOT NULL,  -- Encrypted JSON of survey responses
     submitted_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-    ip_hash TEXT,  -- Hashed IP for audit trail
+    ip_hash BLOB,  -- Keyed BLAKE2b hash of IP for audit trail (16 bytes)
     FOREIGN KEY (company_id) REFERENCES portfolio_companies(id)
 );
 
@@ -87,7 +96,11 @@ CREATE TABLE compliance_access_log (
 );
 
 -- Indexes
-CREATE INDEX idx_company_year ON portfolio_companies(investment_year);
-CREATE INDEX idx_aggregated_company ON aggregated_responses(company_id);
+-- portfolio_companies.survey_link_token needs no explicit index: its UNIQUE
+-- constraint already creates one, which survey lookups by token use.
+-- Serves both the DFPI export (WHERE investment_year = ? ORDER BY company_name)
+-- and the admin list (ORDER BY investment_year DESC, company_name) without a sort
+CREATE INDEX idx_company_year_name ON portfolio_companies(investment_year DESC, company_name);
+CREATE UNIQUE INDEX idx_ar_company ON aggregated_responses(company_id);
 CREATE INDEX idx_individual_company ON individual_responses(company_id);
 CREATE INDEX idx_access_log_time ON compliance_access_log(accessed_at);
@@ -60,9 +60,10 @@ echo ""
 echo "⚠️  IMPORTANT: Before deploying to production:"
 echo "  1. Set ENCRYPTION_KEY environment variable"
 echo "  2. Set SECRET_KEY environment variable"
-echo "  3. Switch to PostgreSQL/MySQL"
-echo "  4. Enable HTTPS"
-echo "  5. Add authentication"
+echo "  3. Set IP_HASH_KEY environment variable"
+echo "  4. Switch to PostgreSQL/MySQL"
+echo "  5. Enable HTTPS"
+echo "  6. Add authentication"
 echo ""
 echo "See README.md for detailed instructions."
 echo ""
@@ -4,10 +4,18 @@ Test script for VCC Demographic Survey System
 Verifies data separation, encryption, and aggregation
 """
 
+import os
+import re
+import shutil
 import sqlite3
+import tempfile
+import threading
+import time
+import app
 from app import (
-    init_db, generate_survey_token, encrypt_response, 
-    decrypt_response, get_db, calculate_diverse_status
+    DB_PATH, init_db, generate_survey_token, encrypt_response,
+    decrypt_response, calculate_diverse_status,
+    AGG_COUNT_COLUMNS, _PendingSubmission, _submit_queue, _flush_now, commit_submission
 )
 
 print("🧪 VCC Survey System Tests\n")
@@ -15,7 +23,8 @@ print("🧪 VCC Survey System Tests\n")
 # Test 1: Database initialization
 print("1️⃣ Testing database initialization...")
 init_db()
-conn = get_db()
+conn = sqlite3.connect(DB_PATH)
+conn.row_factory = sqlite3.Row
 tables = conn.execute("SELECT name FROM sqlite_master WHERE type='table'").fetchall()
 table_names = [t[0] for t in tables]
 expected_tables = ['portfolio_companies', 'aggregated_responses', 'individual_responses', 'compliance_access_log']
@@ -178,16 +187,154 @@ print(f"   Response rate: {agg_dict['total_responses']}/{agg_dict['total_founder
 print(f"   Diverse identifications: woman(1), nonbinary(1), transgender(1), black(1), asian(1), hispanic(1), lgbtq(2), disability(1)")
 print(f"   Primarily diverse: {is_diverse}")
 assert is_diverse == True, "Should be primarily diverse"
+# The generated column must agree with the Python calculation
+assert aggregated['is_primarily_diverse'] == is_diverse, "Generated column disagrees with calculate_diverse_status"
+
+# Insufficient responses (2 of 4 founders) and a non-diverse company
+for company_name, founders, responses_made, counts in [
+    ('Few Responses', 4, 2, 'gender_woman = 2'),
+    ('Not Diverse', 2, 2, 'gender_man = 2'),
+]:
+    company_id = conn.execute(
+        'INSERT INTO portfolio_companies (company_name, investment_year, survey_link_token) VALUES (?, ?, ?)',
+        (company_name, 2025, generate_survey_token())
+    ).lastrowid
+    conn.execute(
+        'INSERT INTO aggregated_responses (company_id, total_founders) VALUES (?, ?)',
+        (company_id, founders)
+    )
+    conn.execute(
+        f'UPDATE aggregated_responses SET total_responses = ?, {counts} WHERE company_id = ?',
+        (responses_made, company_id)
+    )
+    conn.commit()
+    row = conn.execute('SELECT * FROM aggregated_responses WHERE company_id = ?', (company_id,)).fetchone()
+    assert row['is_primarily_diverse'] == calculate_diverse_status(dict(row)), f"{company_name}: generated column disagrees"
+    expected = None if company_name == 'Few Responses' else 0
+    assert row['is_primarily_diverse'] == expected, f"{company_name}: expected {expected}"
 print("   ✅ Diverse status calculation correct\n")
 
-# Test 7: Verify no linkage between tiers
-print("7️⃣ Verifying no linkage between operational and compliance data...")
+# Test 7: Migrating a database created from the original schema
+print("7️⃣ Testing migration of an original-schema database...")
+with open('schema.sql') as f:
+    schema = f.read()
+# Rebuild the original schema: stored flag column and the old indexes
+old_schema, n = re.subn(
+    r'is_primarily_diverse INTEGER GENERATED ALWAYS AS \(.*?\) VIRTUAL',
+    'is_primarily_diverse BOOLEAN', schema, flags=re.S
+)
+assert n == 1, "schema.sql changed shape; update the original-schema rebuild"
+for new, old in [
+    ('CREATE UNIQUE INDEX idx_ar_company ON', 'CREATE INDEX idx_aggregated_company ON'),
+    ('idx_company_year_name ON portfolio_companies(investment_year DESC, company_name)',
+     'idx_company_year ON portfolio_companies(investment_year)'),
+]:
+    assert new in old_schema, "schema.sql changed shape; update the original-schema rebuild"
+    old_schema = old_schema.replace(new, old)
+
+old_dir = tempfile.mkdtemp()
+old_db = os.path.join(old_dir, 'old.db')
+old_conn = sqlite3.connect(old_db)
+old_conn.executescript(old_schema)
+old_conn.execute(
+    "INSERT INTO portfolio_companies (company_name, investment_year, survey_link_token) VALUES ('Old Co', 2024, 'old-token')"
+)
+# Stored flag is stale: the counts say primarily diverse
+old_conn.execute(
+    'INSERT INTO aggregated_responses (company_id, total_founders, total_responses, race_black, is_primarily_diverse) '
+    'VALUES (1, 2, 2, 2, 0)'
+)
+old_conn.commit()
+old_conn.close()
+
+app.DB_PATH = old_db
+try:
+    init_db()
+finally:
+    app.DB_PATH = DB_PATH
+old_conn = sqlite3.connect(old_db)
+old_conn.row_factory = sqlite3.Row
+assert old_conn.execute('PRAGMA user_version').fetchone()[0] == len(app.MIGRATIONS), "Migrations not recorded"
+migrated = old_conn.execute('SELECT * FROM aggregated_responses WHERE company_id = 1').fetchone()
+assert migrated['race_black'] == 2, "Counts lost in migration"
+assert migrated['is_primarily_diverse'] == 1, "is_primarily_diverse not generated after migration"
+indexes = {r['name']: r['unique'] for r in old_conn.execute("PRAGMA index_list('aggregated_responses')")}
+assert indexes.get('idx_ar_company') == 1 and 'idx_aggregated_company' not in indexes, "Unique company index not migrated"
+old_conn.close()
+shutil.rmtree(old_dir)
+print("   ✅ Original-schema database migrated\n")
+
+# Test 8: Verify no linkage between tiers
+print("8️⃣ Verifying no linkage between operational and compliance data...")
 # Aggregated data has no individual identifiers
 assert 'response_data_encrypted' not in dict(aggregated), "Aggregated data contains encrypted data"
 # Individual responses have no demographic counts
 assert 'gender_woman' not in dict(individual[0]), "Individual responses contain aggregated counts"
 print("   ✅ Data tiers properly separated\n")
 
+# Test 9: Batched (group-committed) survey writes
+print("9️⃣ Testing batched survey writes...")
+
+def pending_submission(company_id):
+    """A submission counting one 'woman' answer for company_id"""
+    counts = [1 if c == 'gender_woman' else 0 for c in AGG_COUNT_COLUMNS]
+    return _PendingSubmission(
+        (company_id, encrypt_response({'gender': 'woman'}), b'test_hash'),
+        (company_id, *counts, '2025-01-01T00:00:00')
+    )
+
+# A batch holding one bad submission (no such company) only fails that one
+good, bad = pending_submission(1), pending_submission(999)
+_submit_queue.put(good)
+_submit_queue.put(bad)
+_flush_now()
+assert good.done.is_set() and good.error is None, "Good submission failed with a bad one"
+assert bad.done.is_set() and isinstance(bad.error, sqlite3.IntegrityError), "Bad submission not rejected"
+
+# Concurrent submitters through the writer thread all get counted
+def submit_many():
+    for _ in range(10):
+        commit_submission(pending_submission(1))
+
+threads = [threading.Thread(target=submit_many) for _ in range(8)]
+for t in threads:
+    t.start()
+for t in threads:
+    t.join()
+
+aggregated = conn.execute('SELECT * FROM aggregated_responses WHERE company_id = 1').fetchone()
+assert aggregated['total_responses'] == 3 + 1 + 80, "Batched response count incorrect"
+assert aggregated['gender_woman'] == 1 + 1 + 80, "Batched gender count incorrect"
+individual_count = conn.execute('SELECT COUNT(*) FROM individual_responses WHERE company_id = 1').fetchone()[0]
+assert individual_count == 3 + 1 + 80, "Batched individual response count incorrect"
+assert conn.execute('SELECT COUNT(*) FROM individual_responses WHERE company_id = 999').fetchone()[0] == 0
+print("   ✅ 81 batched submissions committed, bad submission rejected alone")
+
+# A submission that times out before the writer picks it up is never written
+app._write_lock.acquire()  # stall the writer inside its next transaction
+stalled = pending_submission(1)
+stalled_thread = threading.Thread(target=commit_submission, args=(stalled,))
+stalled_thread.start()
+while not stalled.taken:
+    time.sleep(0.01)
+timed_out = pending_submission(2)
+app.SUBMIT_TIMEOUT = 0.2
+try:
+    commit_submission(timed_out)
+    assert False, "Submission should have timed out"
+except TimeoutError:
+    pass
+finally:
+    app.SUBMIT_TIMEOUT = 30
+    app._write_lock.release()
+stalled_thread.join()
+_flush_now()
+assert timed_out.cancelled and not timed_out.taken, "Timed-out submission not cancelled"
+assert stalled.done.is_set() and stalled.error is None, "Stalled submission not committed"
+assert conn.execute('SELECT COUNT(*) FROM individual_responses WHERE company_id = 2').fetchone()[0] == 0, \
+    "Cancelled submission was written"
+print("   ✅ Timed-out submission cancelled, not written later\n")
+
 conn.close()
 
 print("=" * 50)
@@ -201,6 +348,8 @@ print("  • Survey submission: ✅")
 print("  • Data aggregation: ✅")
 print("  • Data separation: ✅")
 print("  • Diverse status calculation: ✅")
+print("  • Schema migration: ✅")
+print("  • Batched survey writes: ✅")
 print("\n🔒 Security verification:")
 print("  • Individual responses encrypted: ✅")
 print("  • Tier 1 has no PII: ✅")